@@ -8,19 +8,231 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-
+import os
+import ctypes
+import hashlib
+import warnings
+import tempfile
+import subprocess
 import pyDOE
 import numpy as np
 import casadi as ca
 import scipy.linalg
+import scipy.integrate
 import matplotlib.pyplot as plt
 from matplotlib.font_manager import FontProperties
 
 
+def _compile_library(fun, directory, flags, options=None, jacobian=True,
+                     driver=''):
+    """ Generate C code for a CasADi function and compile a shared library
+
+        The generated C code is hashed together with the compiler flags, so
+        the shared library is only compiled once and reused across runs.
+        The C code in driver is appended to the generated code.
+
+    # Returns:
+        Path to the shared library
+    """
+    gen = ca.CodeGenerator(fun.name() + '.c', options or {})
+    gen.add(fun)
+    if jacobian:
+        gen.add(fun.jacobian())
+    code = gen.dump() + driver
+
+    key = hashlib.sha1((code + ' '.join(flags)).encode()).hexdigest()[:16]
+    name = os.path.join(directory, '%s_%s' % (fun.name(), key))
+    if not os.path.isfile(name + '.so'):
+        os.makedirs(directory, exist_ok=True)
+        with open(name + '.c', 'w') as f:
+            f.write(code)
+        # Compile to a temporary file to not load a partially written library
+        tmp = '%s.%d.so' % (name, os.getpid())
+        subprocess.run(['gcc', *flags, '-shared', '-fPIC', name + '.c',
+                        '-o', tmp], check=True)
+        os.replace(tmp, name + '.so')
+    return name + '.so'
+
+
+def compile_external(fun, directory, flags=('-O3', '-march=native')):
+    """ Compile a CasADi function ahead of time and load it as external
+
+    # Arguments:
+        fun: CasADi function
+        directory: Directory where the C code and shared library are stored
+        flags: Compiler flags passed to gcc
+
+    # Returns:
+        External CasADi function, with the jacobian compiled alongside
+    """
+    return ca.external(fun.name(), _compile_library(fun, directory, flags))
+
+
+# Driver evaluating a generated function for a batch of N samples, where
+# input and output i of sample k are at arg[i] + k*nnz_in[i] and
+# res[i] + k*nnz_out[i]
+_BATCH_DRIVER = """
+CASADI_SYMBOL_EXPORT int %(name)s_batch(const casadi_real** arg,
+    casadi_real** res, casadi_int* iw, casadi_real* w, int N) {
+  static const casadi_int nnz_in[] = {%(nnz_in)s};
+  static const casadi_int nnz_out[] = {%(nnz_out)s};
+  const casadi_real* a[%(sz_arg)d] = {0};
+  casadi_real* r[%(sz_res)d] = {0};
+  casadi_int i, k;
+  for (k = 0; k < N; ++k) {
+    for (i = 0; i < %(n_in)d; ++i) a[i] = arg[i] + k*nnz_in[i];
+    for (i = 0; i < %(n_out)d; ++i) r[i] = res[i] + k*nnz_out[i];
+    if (%(name)s(a, r, iw, w, 0)) return 1;
+  }
+  return 0;
+}
+"""
+
+
+def compile_float32(fun, directory, flags=('-O3', '-march=native',
+                                          '-fsingle-precision-constant')):
+    """ Compile a CasADi function to single precision C code
+
+        The function is generated with float as casadi_real and called
+        through ctypes, since CasADi itself only evaluates in double.
+        A batch of evaluations is looped over in C by a driver compiled
+        alongside the function, so the same shared library is used for any
+        number of evaluations.
+
+    # Arguments:
+        fun: CasADi function with dense inputs and outputs
+        directory: Directory where the C code and shared library are stored
+        flags: Compiler flags passed to gcc
+
+    # Returns:
+        Function taking float32 matrices (N, nnz_in) with the nonzeros of
+        each input at each row, in CasADi's column-major order, and returning
+        a list of float32 matrices (N, nnz_out) with the nonzeros of each
+        output, evaluated row by row
+    """
+    driver = _BATCH_DRIVER % {
+        'name': fun.name(),
+        'n_in': fun.n_in(),
+        'n_out': fun.n_out(),
+        'nnz_in': ', '.join(str(fun.nnz_in(i)) for i in range(fun.n_in())),
+        'nnz_out': ', '.join(str(fun.nnz_out(i)) for i in range(fun.n_out())),
+        'sz_arg': max(fun.sz_arg(), 1),
+        'sz_res': max(fun.sz_res(), 1),
+    }
+    lib = ctypes.CDLL(_compile_library(fun, directory, flags,
+                                       {'casadi_real': 'float'},
+                                       jacobian=False, driver=driver))
+    f = getattr(lib, fun.name() + '_batch')
+    f.argtypes = [ctypes.c_void_p] * 4 + [ctypes.c_int]
+
+    # Size of the work vectors
+    sz = [ctypes.c_longlong() for i in range(4)]
+    getattr(lib, fun.name() + '_work')(*[ctypes.byref(i) for i in sz])
+    sz_iw, sz_w = sz[2].value, sz[3].value
+    iw = np.empty(sz_iw, dtype=np.int64)
+    w = np.empty(sz_w, dtype=np.float32)
+
+    def call(*args):
+        args = [np.ascontiguousarray(a, dtype=np.float32) for a in args]
+        N = args[0].shape[0]
+        res = [np.empty((N, fun.nnz_out(i)), dtype=np.float32)
+               for i in range(fun.n_out())]
+        arg_p = (ctypes.c_void_p * len(args))(*[a.ctypes.data for a in args])
+        res_p = (ctypes.c_void_p * len(res))(*[r.ctypes.data for r in res])
+        if f(arg_p, res_p, iw.ctypes.data, w.ctypes.data, N):
+            raise RuntimeError('Evaluation of %s failed' % fun.name())
+        return res
+
+    return call
+
+
+def _columns_to_rows(M):
+    """ Convert a CasADi matrix (Nx, N) to a numpy array (N, Nx)
+
+        CasADi stores matrices column-major, so the nonzeros of a dense matrix
+        are already the rows of the result, and no transpose is needed.
+    """
+    return np.reshape(ca.densify(M).nonzeros(), (M.size2(), M.size1()))
+
+
+def _integrate_samples(step, X, U, P):
+    """ Integrate the samples in the rows of X, U and P one time step """
+    return _columns_to_rows(step.map(X.shape[0])(X.T, U.T, P.T))
+
+
+def jax_batch_integrator(ode_jax, dt):
+    """ Build a batched integrator of a JAX ODE with diffrax
+
+        The integration of one sample is vectorized over the batch with
+        jax.vmap and compiled with jax.jit, so all samples are integrated in
+        a single XLA kernel.
+
+    # Arguments:
+        ode_jax: ode_jax(x, u, p) returning dx/dt, written with jax.numpy
+        dt: Sampling time
+
+    # Returns:
+        integrate: integrate(X, U, P) returning the states (N, Nx) at t0 + dt
+                   from the states X (N, Nx), inputs U (N, Nu) and
+                   parameters P (N, Np)
+    """
+    import jax
+    import diffrax
+
+    term = diffrax.ODETerm(lambda t, x, args: ode_jax(x, *args))
+    solver = diffrax.Dopri5()
+
+    def integrate(x0, u, p):
+        sol = diffrax.diffeqsolve(term, solver, 0.0, dt, dt / 10, x0,
+                                  args=(u, p))
+        return sol.ys[-1]
+
+    return jax.jit(jax.vmap(integrate))
+
+
+def numba_rk4(ode_py, dt):
+    """ Compile a RK4 stepper and simulator for a Python ODE with Numba
+
+    # Arguments:
+        ode_py: ode_py(x, u, p) returning dx/dt as a numpy array, written in
+                the subset of Python and numpy supported by Numba
+        dt: Sampling time
+
+    # Returns:
+        rk4_step: rk4_step(x, u, p) returning x at t0 + dt
+        rk4_sim: rk4_sim(x0, U, P) returning the states (Nt, Nx) from the
+                 inputs U (Nt, Nu) and parameters P (Nt, Np)
+    """
+    import numba
+
+    f = numba.njit(fastmath=True)(ode_py)
+
+    @numba.njit(fastmath=True)
+    def rk4_step(x, u, p):
+        k1 = f(x, u, p)
+        k2 = f(x + dt/2*k1, u, p)
+        k3 = f(x + dt/2*k2, u, p)
+        k4 = f(x + dt*k3, u, p)
+        return x + dt/6*(k1 + 2*k2 + 2*k3 + k4)
+
+    @numba.njit(fastmath=True)
+    def rk4_sim(x0, U, P):
+        Y = np.empty((U.shape[0], x0.shape[0]))
+        x = x0
+        for t in range(U.shape[0]):
+            x = rk4_step(x, U[t], P[t])
+            Y[t] = x
+        return Y
+
+    return rk4_step, rk4_sim
+
+
 class Model:
     def __init__(self, Nx, Nu, ode, dt, R=None,
                  alg=None, alg_0=None, Nz=0, Np=0,
-                 opt=None, clip_negative=False):
+                 opt=None, clip_negative=False, jit=False, compile_dir=None,
+                 ode_py=None, expand=True, fast=False, Ns=1, ode_jax=None,
+                 seed=None):
         """ Initialize dynamic model
 
         # Arguments:
@@ -37,14 +249,39 @@ class Model:
             Np:  Number of parameters
             opt: Options dict to pass to the IDEAS integrator
             clip_negative: If true, clip negative simulated outputs to zero
+            jit: If true, just-in-time compile the ODE and the RK4 model to
+                 native code (requires a C compiler)
+            compile_dir: Directory to cache the ahead-of-time compiled ODE
+                 (or RK4 step if fast is true) used in simulations, if None
+                 nothing is compiled ahead of time
+            ode_py: ode_py(x, u, p) Python version of the ODE, compiled with
+                 Numba to a RK4 simulator used by sim_fast
+            expand: If true, expand the ODE and the RK4 model to SX
+                 expressions for faster evaluation
+            fast: If true, simulate with an explicit RK4 scheme instead of
+                 the exact integrator (only for ODE models)
+            Ns:  Number of RK4 steps per sampling time when fast is true
+            ode_jax: ode_jax(x, u, p) JAX version of the ODE, used to
+                 integrate training data in batch by generate_training_data_gpu
+            seed: Seed or np.random.Generator used to draw the noise
         """
 
         # Create a default noise covariance matrix
         if R is None:
-            self.__R = np.eye(self.__Ny) * 1e-3
+            self.__R = np.eye(Nx) * 1e-3
         else:
             self.__R = R
 
+        # Factorize the noise covariance once, so noise can be drawn from
+        # standard normal samples
+        try:
+            self.__L = np.linalg.cholesky(self.__R)
+        except np.linalg.LinAlgError:
+            # Positive semidefinite covariance
+            eig, V = np.linalg.eigh(self.__R)
+            self.__L = V * np.sqrt(eig.clip(min=0))
+        self.__rng = np.random.default_rng(seed)
+
         self.__dt   = dt
         self.__Nu = Nu
         self.__Nx = Nx
@@ -52,6 +289,15 @@ class Model:
         self.__Np = Np
         self.__clip_negative = clip_negative
 
+        # Options to compile CasADi functions to native code with -O3
+        if jit:
+            self.__jit_opts = {'jit': True, 'compiler': 'shell',
+                               'jit_options': {'flags': ['-O3', '-march=native'],
+                                               'verbose': False}}
+        else:
+            self.__jit_opts = {}
+        self.__expand = expand
+
         """ Create integrator """
         # Integrator options
         options = {
@@ -59,9 +305,12 @@ class Model:
             "reltol" : 1e-9,
             "max_num_steps": 100,
             "tf" : dt,
+            # Expand the DAE unless it is already a compiled function
+            "expand" : expand and not jit,
         }
         if opt is not None:
             options.update(opt)
+        self.__tol = (options['reltol'], options['abstol'])
 
         x = ca.MX.sym('x', Nx)
         u = ca.MX.sym('u', Nu)
@@ -69,25 +318,81 @@ class Model:
         p = ca.MX.sym('p', Np)
         par = ca.vertcat(u, p)
 
-        dae = {'x': x, 'ode': ode(x,u,z,p), 'p':par}
+        ode_x = ode(x, u, z, p)
+        ode_fun = ca.Function('ode', [x, u, z, p], [ode_x])
+        if expand and (jit or compile_dir is not None):
+            # The ODE is only expanded when it is compiled
+            ode_fun = ode_fun.expand()
+        if jit:
+            ode_x = ca.Function('ode', [x, u, z, p], [ode_fun(x, u, z, p)],
+                                self.__jit_opts)(x, u, z, p)
+
+        dae = {'x': x, 'ode': ode_x, 'p':par}
         if alg is not None:
             self.__alg0 = ca.Function('alg_0', [x, u],
                                       [alg_0(x, u)])
             dae.update({'z':z, 'alg': alg(x, z, u)})
-            self.Integrator = ca.integrator('DEA_Integrator', 'idas', dae, options)
+            name, solver = 'DEA_Integrator', 'idas'
         else:
-            self.Integrator = ca.integrator('ODE_Integrator', 'cvodes', dae, options)
+            name, solver = 'ODE_Integrator', 'cvodes'
+        self.Integrator = ca.integrator(name, solver, dae, options)
+
+        # Integrator used in simulations, with the ODE compiled ahead of time
+        # when a cache directory is given
+        if compile_dir is not None:
+            ode_ext = compile_external(ode_fun, compile_dir)
+            dae.update({'ode': ode_ext(x, u, z, p)})
+            integrator = ca.integrator(name, solver, dae,
+                                       dict(options, expand=False))
+        else:
+            integrator = self.Integrator
+        self.__integrator = integrator
+
+        # Preallocated buffer for the integrator parameters vertcat(u, p)
+        self.__par_buf = np.empty(Nu + Np)
+
+        # One step of the exact discretization, used to build the accumulated
+        # map that simulates a whole trajectory in a single CasADi call
+        if alg is not None:
+            xf = integrator(x0=x, p=par, z0=self.__alg0(x, u))['xf']
+        else:
+            xf = integrator(x0=x, p=par)['xf']
+        self.__step = ca.Function('step', [x, u, p], [xf],
+                                  ['x0', 'u', 'p'], ['xf'])
+        self.__sim_map = {}
+        self.__data_map = {}
+        self.__step32 = None
+
+        # Numba compiled RK4 model of the Python ODE
+        if ode_py is not None:
+            self.rk4_fast, self.__rk4_sim = numba_rk4(ode_py, dt)
+        else:
+            self.rk4_fast, self.__rk4_sim = None, None
+
+        # Batched JAX integrator of the training data
+        if ode_jax is not None:
+            self.__batch_jax = jax_batch_integrator(ode_jax, dt)
+        else:
+            self.__batch_jax = None
 
         #TODO: Fix discrete DAE model
         if alg is None:
             """ Create discrete RK4 model """
             ode_casadi = ca.Function("ode", [x, u, p], [ode(x,u,z,p)])
-            k1 = ode_casadi(x, u, p)
-            k2 = ode_casadi(x + dt/2*k1, u, p)
-            k3 = ode_casadi(x + dt/2*k2, u, p)
-            k4 = ode_casadi(x + dt*k3,u, p)
-            xrk4 = x + dt/6*(k1 + 2*k2 + 2*k3 + k4)
-            self.rk4 = ca.Function("ode_rk4", [x, u, p], [xrk4])
+
+            def rk4_step(x, h):
+                k1 = ode_casadi(x, u, p)
+                k2 = ode_casadi(x + h/2*k1, u, p)
+                k3 = ode_casadi(x + h/2*k2, u, p)
+                k4 = ode_casadi(x + h*k3,u, p)
+                return x + h/6*(k1 + 2*k2 + 2*k3 + k4)
+
+            xrk4 = rk4_step(x, dt)
+            self.rk4 = self.__compile(ca.Function("ode_rk4", [x, u, p], [xrk4]))
+
+            # ODE evaluated by the SciPy integrators, compiled like the one in
+            # the simulation integrator
+            self.__ode_scipy = ca.Function('ode_scipy', [x, u, p], [dae['ode']])
 
             # Jacobian of continuous system
             self.__jac_x = ca.Function('jac_x', [x, u, p],
@@ -101,6 +406,38 @@ class Model:
             self.__discrete_rk4_jac_u = ca.Function('jac_x', [x, u, p],
                                         [ca.jacobian(self.rk4(x,u,p), u)])
 
+        # Explicit RK4 with Ns steps over dt replaces the exact integrator in
+        # simulations, avoiding the solver overhead for non-stiff systems
+        if not isinstance(Ns, (int, np.integer)) or isinstance(Ns, bool) or Ns < 1:
+            raise ValueError('Ns must be a positive integer, got %r' % (Ns,))
+        self.__fast = fast and alg is None
+        if self.__fast:
+            xf = x
+            for i in range(Ns):
+                xf = rk4_step(xf, dt / Ns)
+            step = ca.Function('rk4_nx%d_nu%d_np%d' % (Nx, Nu, Np),
+                               [x, u, p], [xf], ['x0', 'u', 'p'], ['xf'])
+            if expand:
+                step = step.expand()
+            self.__step_sym = step
+            if compile_dir is not None:
+                # The dimensions are constants in the generated code, so the
+                # compiler can fully unroll the RK4 updates
+                self.__step = compile_external(step, compile_dir,
+                                               flags=('-O3', '-march=native',
+                                                      '-funroll-all-loops'))
+            else:
+                self.__step = self.__compile(step)
+        self.__compile_dir = compile_dir
+
+        # Select the integration method once, instead of on every call
+        if self.__fast:
+            self.__integrate = self.__integrate_rk4
+        elif alg is not None:
+            self.__integrate = self.__integrate_dae
+        else:
+            self.__integrate = self.__integrate_ode
+
         # Jacobian of exact discretization
         self.__discrete_jac_x = ca.Function('jac_x', [x, u, p],
                                    [ca.jacobian(self.Integrator(x0=x,
@@ -231,13 +568,65 @@ class Model:
         # Returns:
             x: Numpy array with x at t0 + dt
         """
-        par=ca.vertcat(u, p)
-        if self.__Nz is not 0:
-            z0 = self.__alg0(x0, u)
-            out = self.Integrator(x0=x0, p=u, z0=z0)
-        else:
-            out = self.Integrator(x0=x0, p=par)
-        return np.array(out["xf"]).flatten()
+        return self.__integrate(x0, u, p)
+
+
+    def __integrate_ode(self, x0, u, p):
+        """ Integrate one time sample dt with the ODE integrator """
+        # Fill the parameter buffer instead of building vertcat(u, p)
+        par = self.__par_buf
+        par[:self.__Nu] = u
+        par[self.__Nu:] = p
+        return self.__integrator(x0=x0, p=par)['xf'].full().ravel()
+
+
+    def __integrate_dae(self, x0, u, p):
+        """ Integrate one time sample dt with the DAE integrator """
+        par = self.__par_buf
+        par[:self.__Nu] = u
+        par[self.__Nu:] = p
+        z0 = self.__alg0(x0, u)
+        return self.__integrator(x0=x0, p=par, z0=z0)['xf'].full().ravel()
+
+
+    def __integrate_rk4(self, x0, u, p):
+        """ Integrate one time sample dt with the explicit RK4 step """
+        return self.__step(x0, u, p).full().ravel()
+
+
+    def integrate_scipy(self, x0, u, p, method='LSODA'):
+        """ Integrate one time sample dt with SciPy
+
+            Alternative to the SUNDIALS integrators for ODE models, using
+            scipy.integrate.solve_ivp with the CasADi ODE and its jacobian.
+
+        # Arguments:
+            x0: Initial state vector
+            u: Input vector
+            p: Parameter vector
+            method: Integration method passed to solve_ivp
+        # Returns:
+            x: Numpy array with x at t0 + dt
+        """
+        if self.__Nz != 0:
+            raise ValueError('integrate_scipy only supports ODE models')
+
+        def fun(t, x):
+            return self.__ode_scipy(x, u, p).full().ravel()
+
+        rtol, atol = self.__tol
+        options = {'method': method, 'rtol': rtol, 'atol': atol}
+
+        # Only the implicit methods make use of the jacobian
+        if method in ('Radau', 'BDF', 'LSODA'):
+            options['jac'] = lambda t, x: self.__jac_x(x, u, p).full()
+
+        sol = scipy.integrate.solve_ivp(fun, (0.0, self.__dt),
+                                        np.array(x0, dtype=float).flatten(),
+                                        **options)
+        if not sol.success:
+            raise RuntimeError(sol.message)
+        return sol.y[:, -1]
 
 #TODO: Fix this or remove
     def set_method(self, method='exact'):
@@ -261,43 +650,147 @@ class Model:
 
         Nt = np.size(u, 0)
 
-        # Initial state of the system
-        x = x0
+        # Stack inputs and parameters column-wise, one column per time step.
+        # The transposed views are column-major, matching the CasADi layout
+        U = np.reshape(u, (Nt, self.__Nu)).T
+        if p is not None:
+            P = np.reshape(p, (Nt, self.__Np)).T
+        else:
+            P = np.zeros((0, Nt))
+
+        try:
+            Y = _columns_to_rows(self.__sim_function(Nt)(x0, U, P))
+        except RuntimeError:
+            # Step through the horizon to locate where the simulator crashed,
+            # keeping the state as a CasADi matrix between the steps
+            Y = np.empty((Nt, self.__Nx))
+            step = self.__step
+            x = ca.DM(x0)
+            for t in range(Nt):
+                try:
+                    x = step(x, U[:, t], P[:, t])
+                except RuntimeError:
+                    print('----------------------------------------')
+                    print('** System unstable, simulator crashed **')
+                    print('** t: %d **' % t)
+                    print('----------------------------------------')
+                    # Only the outputs before the crash are noisy and clipped
+                    Y[t:, :] = 0
+                    self.__add_noise(Y[:t, :], noise)
+                    return Y
+                Y[t, :] = x.full().ravel()
+        return self.__add_noise(Y, noise)
+
+
+    def sim_fast(self, x0, u, p=None, noise=False):
+        """ Simulate system with the Numba compiled RK4 model
+
+            Requires the Python ODE ode_py given when creating the model.
+            The whole simulation loop runs in compiled code.
+
+        # Arguments:
+            x0: Initial state (Nx, 1)
+            u: Input matrix with the input for each timestep in the
+                simulation horizon (Nt, Nu)
+            p: Parameter matrix with the parameters for each timestep
+                in the simulation horizon (Nt, Np)
+            noise: If True, add gaussian noise using the noise covariance matrix
 
-        # Predefine matrix to collect noisy state outputs
-        Y = np.zeros((Nt, self.__Nx))
+        # Output:
+            Y_sim: Matrix with the simulated outputs (Nt, Ny)
+        """
+        if self.__rk4_sim is None:
+            raise ValueError('sim_fast requires the Python ODE ode_py')
 
-        for t in range(Nt):
-            u_t = u[t, :]    # control input for simulation
-            if p is not None:
-                p_t = p[t, :]    # parameter at step t
-            else:
-                p_t = []
-            try:
-                x = self.integrate(x, u_t, p_t).flatten()
-            except RuntimeError:
-                print('----------------------------------------')
-                print('** System unstable, simulator crashed **')
-                print('** t: %d **' % t)
-                print('----------------------------------------')
-                return Y
-            Y[t, :] = x
-
-            # Add normal white noise to state outputs
-            if noise:
-                Y[t, :] += np.random.multivariate_normal(
-                                    np.zeros((self.__Nx)), self.__R)
-
-            # Limit values to above 1e-8 to avvoid to avvoid numerical errors
-            if self.__clip_negative:
-                if np.any(Y < 0):
-                    print('Clipping negative values in simulation!')
-                    Y = Y.clip(min=1e-6)
+        Nt = np.size(u, 0)
+        U = np.reshape(u, (Nt, self.__Nu)).astype(float)
+        if p is not None:
+            P = np.reshape(p, (Nt, self.__Np)).astype(float)
+        else:
+            P = np.zeros((Nt, 0))
+
+        Y = self.__rk4_sim(np.array(x0, dtype=float).flatten(), U, P)
+        return self.__add_noise(Y, noise)
+
+
+    def __add_noise(self, Y, noise):
+        """ Add measurement noise to, and clip, the simulated outputs """
+        # Add normal white noise to state outputs
+        if noise:
+            Y += self.__noise(np.size(Y, 0))
+
+        # Limit values to above 1e-8 to avvoid to avvoid numerical errors
+        if self.__clip_negative and np.any(Y < 0):
+            print('Clipping negative values in simulation!')
+            np.maximum(Y, 1e-6, out=Y)
         return Y
 
 
+    def __sim_function(self, Nt):
+        """ Get the integrator accumulated over Nt time steps
+
+            The function is built on the first call for each horizon length
+            and reused on subsequent simulations.
+        """
+        if Nt not in self.__sim_map:
+            sim = self.__step.mapaccum('sim', Nt)
+            if self.__fast and self.__expand and not self.__jit_opts \
+                    and self.__compile_dir is None:
+                # Fuse the RK4 steps over the horizon into a single SX
+                # function. Compiled steps are looped over instead, as
+                # compiling the unrolled horizon costs more than it gains.
+                sim = sim.expand()
+            self.__sim_map[Nt] = sim
+        return self.__sim_map[Nt]
+
+
+    def __compile(self, fun):
+        """ Expand to SX and/or JIT compile a CasADi function """
+        opts = self.__jit_opts
+        if self.__expand:
+            return fun.expand(fun.name(), opts)
+        if opts:
+            args = fun.mx_in()
+            return ca.Function(fun.name(), args, fun.call(args),
+                               fun.name_in(), fun.name_out(), opts)
+        return fun
+
+
+    def __data_function(self, N):
+        """ Get the integrator mapped over N independent samples
+
+            The samples are integrated in parallel on all available cores.
+        """
+        if N not in self.__data_map:
+            self.__data_map[N] = self.__step.map(N, 'thread', os.cpu_count())
+        return self.__data_map[N]
+
+
+    def __step_float32(self):
+        """ Get the RK4 step compiled in single precision
+
+            The step is compiled once and evaluated row by row for any
+            number of samples.
+        """
+        if self.__step32 is None:
+            directory = self.__compile_dir
+            if directory is None:
+                # Private directory removed together with the model, since
+                # libraries in a shared directory could be planted by others
+                self.__tmp_dir = tempfile.TemporaryDirectory(prefix='gp_mpc_')
+                directory = self.__tmp_dir.name
+            self.__step32 = compile_float32(self.__step_sym, directory)
+        return self.__step32
+
+
+    def __noise(self, N):
+        """ Draw N samples of white noise with the noise covariance matrix """
+        return self.__rng.standard_normal((N, self.__Nx)) @ self.__L.T
+
+
     def generate_training_data(self, N, uub, ulb, xub, xlb,
-                               pub=None, plb=None, noise=True):
+                               pub=None, plb=None, noise=True, n_jobs=None,
+                               dtype=np.float64):
         """ Generate training data using latin hypercube design
 
         # Arguments:
@@ -307,59 +800,105 @@ class Model:
             xub: Upper state range (Ny,1)
             xlb: Lower state range (Ny,1)
 
+        # Arguments (optional):
+            pub: Upper parameter range (Np,1)
+            plb: Lower parameter range (Np,1)
+            noise: If True, add gaussian noise using the noise covariance matrix
+            n_jobs: Number of processes used to integrate the samples with
+                joblib (-1 for all cores), if None the samples are
+                integrated on CasADi threads
+            dtype: Data type of the training data, with np.float32 the
+                samples are integrated in single precision by the RK4 fast
+                path (requires an ODE model with fast=True and a C
+                compiler), only np.float32 and np.float64 are supported
+
         # Returns:
             Z: Matrix (N, Nx + Nu) with state x and inputs u at each row
             Y: Matrix (N, Nx) where each row is the state x at time t+dt,
                 with the input from the same row in Z at time t.
         """
-        # Make sure boundry vectors are numpy arrays
-        uub = np.array(uub)
-        ulb = np.array(ulb)
-        xub = np.array(xub)
-        xlb = np.array(xlb)
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError('dtype must be float32 or float64, got %s' % dtype)
+        if dtype == np.float32 and not self.__fast:
+            raise ValueError('Single precision training data requires '
+                             'ODE models with fast=True')
+        if dtype == np.float32 and n_jobs is not None:
+            warnings.warn('n_jobs is ignored with single precision training '
+                          'data, the samples are integrated serially')
+
+        X, U, par = self.__training_design(N, uub, ulb, xub, xlb, pub, plb)
+
+        # Simulate system with all x_t and u_t inputs for deltat time,
+        # with the samples distributed over the available threads or processes
+        if dtype == np.float32:
+            X, U, par = [A.astype(np.float32) for A in (X, U, par)]
+            Y = self.__step_float32()(X, U, par)[0]
+        elif N > 1 and n_jobs is not None:
+            from joblib import Parallel, delayed, effective_n_jobs
+            chunks = np.array_split(np.arange(N), effective_n_jobs(n_jobs))
+            Y = np.vstack(Parallel(n_jobs=n_jobs)(
+                    delayed(_integrate_samples)(self.__step, X[i], U[i], par[i])
+                    for i in chunks if len(i) > 0))
+        elif N > 1:
+            Y = _columns_to_rows(self.__data_function(N)(X.T, U.T, par.T))
+        else:
+            Y = self.integrate(X[0], U[0], par[0]).reshape((1, self.__Nx))
 
-        # Predefine matrix to collect noisy state outputs
-        Y = np.zeros((N, self.__Nx))
+        # Add normal white noise to state outputs
+        if noise:
+            Y += self.__noise(N)
 
-        # Create control input design using a latin hypecube
-        # Latin hypercube design for unit cube [0,1]^Nu
+        # Concatenate previous states and inputs to obtain overall input to GP model
         if self.__Nu > 0:
-            U = pyDOE.lhs(self.__Nu, samples=N, criterion='maximin')
-             # Scale control inputs to correct range
-            for k in range(N):
-                U[k, :] = U[k, :] * (uub - ulb) + ulb
+            Z = np.hstack([X, U])
         else:
-            U = []
+            Z = X
+        return Z, Y
 
-        # Create state input design using a latin hypecube
-        # Latin hypercube design for unit cube [0,1]^Ny
-        X = pyDOE.lhs(self.__Nx, samples=N, criterion='maximin')
 
-        # Scale state inputs to correct range
-        for k in range(N):
-            X[k, :] = X[k, :] * (xub - xlb) + xlb
+    def generate_training_data_gpu(self, N, uub, ulb, xub, xlb,
+                                   pub=None, plb=None, noise=True):
+        """ Generate training data using latin hypercube design, with all
+            samples integrated in one batch by JAX/diffrax
 
-        # Create parameter matrix
-        par = pyDOE.lhs(self.__Np, samples=N)
-        if pub is not None:
-            for k in range(N):
-                par[k, :] = par[k, :] * (pub - plb) + plb
+            Requires the JAX ODE ode_jax given when creating the model. The
+            batch runs on the default JAX device, i.e. the GPU if available.
+            Unless jax_enable_x64 is set, JAX integrates in single precision
+            and the outputs Y are only float32 accurate, although returned
+            as float64.
 
-        for i in range(N):
-            if self.__Nu > 0:
-                u_t = U[i, :]    # control input for simulation
-            else:
-                u_t = []
-            x_t = X[i, :]    # state input for simulation
-            p_t = par[i, :]    # parameter input for simulation
+        # Arguments:
+            N:   Number of data points to be generated
+            uub: Upper input range (Nu,1)
+            ulb: Lower input range (Nu,1)
+            xub: Upper state range (Ny,1)
+            xlb: Lower state range (Ny,1)
+
+        # Arguments (optional):
+            pub: Upper parameter range (Np,1)
+            plb: Lower parameter range (Np,1)
+            noise: If True, add gaussian noise using the noise covariance matrix
 
-            # Simulate system with x_t and u_t inputs for deltat time
-            Y[i, :] = self.integrate(x_t, u_t, p_t)
+        # Returns:
+            Z: Matrix (N, Nx + Nu) with state x and inputs u at each row
+            Y: Matrix (N, Nx) where each row is the state x at time t+dt,
+                with the input from the same row in Z at time t.
+        """
+        if self.__batch_jax is None:
+            raise ValueError('generate_training_data_gpu requires the JAX ODE ode_jax')
+
+        import jax
+        if jax.dtypes.canonicalize_dtype(np.float64) != np.float64:
+            warnings.warn('jax_enable_x64 is disabled, the training data is '
+                          'integrated in single precision')
 
-            # Add normal white noise to state outputs
-            if noise:
-                Y[i, :] += np.random.multivariate_normal(
-                                np.zeros((self.__Nx)), self.__R)
+        X, U, par = self.__training_design(N, uub, ulb, xub, xlb, pub, plb)
+        Y = np.array(self.__batch_jax(X, U, par), dtype=float)
+
+        # Add normal white noise to state outputs
+        if noise:
+            Y += self.__noise(N)
 
         # Concatenate previous states and inputs to obtain overall input to GP model
         if self.__Nu > 0:
@@ -369,6 +908,38 @@ class Model:
         return Z, Y
 
 
+    def __training_design(self, N, uub, ulb, xub, xlb, pub, plb):
+        """ Latin hypercube design of the training inputs
+
+        # Returns:
+            X: Matrix (N, Nx) with the states
+            U: Matrix (N, Nu) with the inputs
+            par: Matrix (N, Np) with the parameters
+        """
+        # Make sure boundry vectors are numpy arrays
+        uub = np.array(uub)
+        ulb = np.array(ulb)
+        xub = np.array(xub)
+        xlb = np.array(xlb)
+
+        Nu, Nx = self.__Nu, self.__Nx
+
+        # Create a joint design of inputs, states and parameters using a
+        # single latin hypecube for the unit cube [0,1]^(Nu + Nx + Np)
+        design = pyDOE.lhs(Nu + Nx + self.__Np, samples=N, criterion='maximin')
+
+        # Scale control and state inputs to correct range
+        U = design[:, :Nu] * (uub - ulb) + ulb
+        X = design[:, Nu:Nu + Nx] * (xub - xlb) + xlb
+
+        # Create parameter matrix
+        par = design[:, Nu + Nx:]
+        if pub is not None:
+            par = par * (np.array(pub) - np.array(plb)) + np.array(plb)
+
+        return X, U, par
+
+
     def plot(self, x0, u, numcols=2):
         """ Simulate and plot model
 
@@ -408,21 +979,21 @@ class Model:
         y_exact = np.vstack([x0, y_exact])
 
         # RK4
-        y_rk4 = np.zeros((Nt + 1 , Nx))
+        y_rk4 = np.empty((Nt + 1 , Nx))
         y_rk4[0] = x0
         for t in range(Nt):
-            y_rk4[t + 1]= np.array(self.rk4(y_rk4[t], u[t-1, :], [])).reshape((Nx,))
+            y_rk4[t + 1]= self.rk4(y_rk4[t], u[t-1, :], []).full().ravel()
 
         #  Linearized Model of Exact discretization
         Ad, Bd = self.discrete_linearize(x0, u[0])
-        y_lin = np.zeros((Nt + 1, Nx))
+        y_lin = np.empty((Nt + 1, Nx))
         y_lin[0] = x0
         for t in range(Nt):
             y_lin[t+1] = Ad @ y_lin[t] + Bd @ u[t]
 
         #  Linearized Model of RK4 discretization
         Ad, Bd = self.discrete_rk4_linearize(x0, u[0])
-        y_rk4_lin = np.zeros((Nt + 1, Nx))
+        y_rk4_lin = np.empty((Nt + 1, Nx))
         y_rk4_lin[0] = x0
         for t in range(Nt):
             y_rk4_lin[t+1] = Ad @ y_rk4_lin[t] + Bd @ u[t]